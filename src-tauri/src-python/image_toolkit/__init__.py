@@ -1,3 +1,4 @@
+from anyio import Lock, to_thread
 from anyio.from_thread import start_blocking_portal
 from pydantic.alias_generators import to_camel
 from pytauri import (
@@ -8,13 +9,17 @@ from pytauri import (
     State
 )
 from pathlib import Path
-from os import getenv
-from typing import Annotated
+from os import getenv, scandir, DirEntry
+from os.path import splitext
+import shutil
+from typing import Annotated, Iterator
 
-from image_toolkit.utils import get_common_prefix, where, get_caption, copy
+from image_toolkit.utils import (
+    get_common_prefix, get_caption_or_create, get_caption_or_none, get_caption_batch, copy, encode_prefix, read_captions, write_caption, write_captions
+)
 from image_toolkit.types import _BaseModel, AppState, DatasetItem
 from image_toolkit.tools import (
-    BrushTool, ConcatTool, ExpandTool, RectTool, SplitTool, TrimTool, ViewTool
+    BrushTool, ConcatTool, ExpandTool, RectTool, SplitTool, TrimTool, ViewTool, _unlink_image
 )
 from image_toolkit.batch_operations import (
     EscapeOperation, UnescapeOperation, AlignResolutionOperation, DeduplicateTagsOperation, ReplaceTagsOperation,
@@ -25,20 +30,41 @@ PYTAURI_GEN_TS = getenv("PYTAURI_GEN_TS") != "0"
 
 commands: Commands = Commands(experimental_gen_ts=PYTAURI_GEN_TS)
 
+# commands hand blocking work to worker threads; this keeps those touching the state from interleaving
+state_lock = Lock()
+
+
+IMAGE_EXT = ('.png', '.jpg', '.jpeg', '.webp', '.gif')
+
 
-IMAGE_EXT = {'.png', '.jpg', '.jpeg', '.webp', '.gif'}
+def _scandir_images(root: str) -> Iterator[DirEntry[str]]:
+    with scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                # like glob, skip subdirectories that vanish or cannot be read
+                try:
+                    yield from _scandir_images(entry.path)
+                except OSError:
+                    pass
+            # splitext, like Path.suffix, gives a dotfile such as '.png' no extension
+            elif splitext(entry.name)[1].lower() in IMAGE_EXT:
+                yield entry
 
 
 @commands.command()
 async def get_state(state: Annotated[AppState, State()]) -> AppState:
-    return state
+    # the response is serialized after we return, so hand out a copy taken while no command is mutating the state
+    async with state_lock:
+        return state.snapshot()
 
 
 @commands.command()
 async def close_folder(state: Annotated[AppState, State()]) -> None:
-    state.folder = None
-    state.tags_prefix = []
-    state.items = []
+    async with state_lock:
+        state.folder = None
+        state.tags_prefix = []
+        state.items = []
+        state.reindex()
 
 class SaveArgs(_BaseModel):
     current: str
@@ -48,47 +74,52 @@ class SaveArgs(_BaseModel):
 
 @commands.command()
 async def save(state: Annotated[AppState, State()], body: SaveArgs) -> str | None:
-    item, idx = where(state.items, lambda it: it.image_path == Path(body.current))
-    
-    result = None
-
-    if body.tags != item.tags:
-        item.tags = body.tags
+    async with state_lock:
+        item, idx = state.find_item(Path(body.current))
 
-        with open(item.caption_path, 'w') as f:
-            f.write(', '.join(state.tags_prefix + item.tags))
+        tags_changed = body.tags != item.tags
+        if tags_changed:
+            item.tags = body.tags
 
-    if body.tool:
-        result = body.tool.run(state, idx)
+            if not body.tool.rewrites_caption:
+                await to_thread.run_sync(write_caption, item.caption_path, item.tags, encode_prefix(state.tags_prefix))
 
-    return result
+        try:
+            return await to_thread.run_sync(body.tool.run, state, idx)
+        except Exception:
+            # the tool was meant to write the edited tags; keep them if it failed before removing the image
+            if tags_changed and body.tool.rewrites_caption and item.image_path.exists():
+                await to_thread.run_sync(write_caption, item.caption_path, item.tags, encode_prefix(state.tags_prefix))
+            raise
 
 @commands.command()
 async def set_prefix(state: Annotated[AppState, State()], body: list[str]) -> None:
     if body == state.tags_prefix:
         return
-    
-    state.tags_prefix = body
 
-    for it in state.items:
-        with open(it.caption_path, 'w') as f:
-            f.write(', '.join(state.tags_prefix + it.tags))
+    async with state_lock:
+        state.tags_prefix = body
+
+        captions = [(it.caption_path, it.tags) for it in state.items]
+
+        await to_thread.run_sync(write_captions, captions, encode_prefix(state.tags_prefix))
 
 @commands.command()
 async def delete_item(state: Annotated[AppState, State()], body: str) -> None:
-    item, idx = where(state.items, lambda it: it.image_path == Path(body))
-    
-    item.caption_path.unlink()
-    item.image_path.unlink()
+    async with state_lock:
+        item, idx = state.find_item(Path(body))
 
-    state.items.pop(idx)
+        await to_thread.run_sync(item.caption_path.unlink)
+        await to_thread.run_sync(_unlink_image, item.image_path)
 
-    pref = get_common_prefix(map(lambda it: it.tags, state.items))
+        state.pop_item(idx)
 
-    if len(pref):
-        for it in state.items:
-            it.tags = it.tags[len(pref):]
-        state.tags_prefix.extend(pref)
+        pref = get_common_prefix(map(lambda it: it.tags, state.items))
+
+        if len(pref):
+            for it in state.items:
+                it.tags = it.tags[len(pref):]
+            state.tags_prefix.extend(pref)
 
 
 type BatchOperationPayload = (
@@ -101,8 +132,9 @@ type BatchOperationPayload = (
 async def batch_operation(state: Annotated[AppState, State()], body: BatchOperationPayload) -> None:
     if state.folder is None:
         return
-    
-    body.run(state)
+
+    async with state_lock:
+        await to_thread.run_sync(body.run, state)
 
 @commands.command()
 async def on_drag(state: Annotated[AppState, State()], body: list[str]) -> str:
@@ -121,46 +153,53 @@ async def on_drag(state: Annotated[AppState, State()], body: list[str]) -> str:
     
     if state.folder is None:
         raise ValueError('No open directory')
-    
+
+    async with state_lock:
+        await to_thread.run_sync(_import_files, paths, state.folder)
+
+    return ''
+
+
+def _import_files(paths: list[Path], folder: Path):
     for it in paths:
-        target = copy(it, state.folder)
+        target = copy(it, folder)
 
-        caption_out = get_caption(target)
-        caption_in = get_caption(it, False)
+        caption_out = get_caption_or_create(target)
+        caption_in = get_caption_or_none(it)
 
         if caption_in is not None:
-            with open(caption_out, 'w') as out, open(caption_in, 'r') as f:
-                out.write(f.read())
-
-    return ''
+            shutil.copyfile(caption_in, caption_out)
 
 
 @commands.command()
 async def open_folder(state: Annotated[AppState, State()], body: str) -> None:
-    p = Path(body)
-    state.folder = p
-    state.tags_prefix = []
-    state.items = []
+    async with state_lock:
+        items, tags_prefix = await to_thread.run_sync(_load_items, body)
+
+        state.folder = Path(body)
+        state.items = items
+        state.tags_prefix = tags_prefix
+        state.reindex()
 
-    for it in p.glob('**/*'):
-        if it.suffix not in IMAGE_EXT:
-            continue
-        
-        caption_path = get_caption(it)
 
-        with open(caption_path) as f:
-            caption = f.read()
+def _load_items(folder: str) -> tuple[list[DatasetItem], list[str]]:
+    images = [Path(entry.path) for entry in _scandir_images(folder)]
+    caption_paths = get_caption_batch(images)
+    captions = read_captions(caption_paths)
 
-        state.items.append(DatasetItem(
+    tags_prefix = get_common_prefix(captions)
+    n = len(tags_prefix)
+
+    items = [
+        DatasetItem.model_construct(
             caption_path=caption_path,
             image_path=it,
-            tags=list(map(lambda it: it.strip(), caption.split(',')))
-        ))
-
-    state.tags_prefix = get_common_prefix(map(lambda it: it.tags, state.items))
+            tags=tags[n:]
+        )
+        for it, caption_path, tags in zip(images, caption_paths, captions)
+    ]
 
-    for it in state.items:
-        it.tags = it.tags[len(state.tags_prefix):]
+    return items, tags_prefix
 
 
 def main() -> int:
@@ -1,10 +1,41 @@
-from typing import Literal
+from typing import Callable, Literal
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from functional import seq
-from re import sub, match as rmatch
+from re import compile as rcompile
+import os
 
 from image_toolkit.types import _BaseModel, AppState
-from image_toolkit.utils import where
+from image_toolkit.utils import encode_prefix, write_captions
+
+
+# parentheses not already escaped, matched in a single pass so any character in the tag is left alone
+_UNESCAPED_PAREN = rcompile(r'(?<!\\)([()])')
+
+
+def _escape_parens(tag: str) -> str:
+    return _UNESCAPED_PAREN.sub(r'\\\1', tag)
+
+
+def _unescape_parens(tag: str) -> str:
+    return tag.replace('\\(', '(').replace('\\)', ')')
+
+
+def _map_tags(state: AppState, fn: Callable[[str], str]):
+    tags_prefix = [fn(tag) for tag in state.tags_prefix]
+    rewrite_all = tags_prefix != state.tags_prefix
+    state.tags_prefix = tags_prefix
+
+    changed = []
+    for it in state.items:
+        tags = [fn(tag) for tag in it.tags]
+
+        if rewrite_all or tags != it.tags:
+            it.tags = tags
+            changed.append(it)
+
+    write_captions(((it.caption_path, it.tags) for it in changed), encode_prefix(state.tags_prefix))
 
 
 class Operation(_BaseModel):
@@ -16,50 +47,29 @@ class EscapeOperation(Operation):
     id: Literal['escape_parentheses']
 
     def run(self, state):
-        for i in range(len(state.tags_prefix)):
-            state.tags_prefix[i] = sub(r'(?<!\\)\(', r'\(', state.tags_prefix[i])
-            state.tags_prefix[i] = sub(r'(?<!\\)\)', r'\)', state.tags_prefix[i])
-
-        for it in state.items:
-            for i in range(len(it.tags)):
-                it.tags[i] = sub(r'(?<!\\)\(', r'\(', it.tags[i])
-                it.tags[i] = sub(r'(?<!\\)\)', r'\)', it.tags[i])
-
-            with open(it.caption_path, 'w') as f:
-                f.write(', '.join(state.tags_prefix + it.tags))
+        _map_tags(state, _escape_parens)
 
 
 class UnescapeOperation(Operation):
     id: Literal['unescape_parentheses']
 
     def run(self, state):
-        for i in range(len(state.tags_prefix)):
-            state.tags_prefix[i] = sub(r'\\\(', r'(', state.tags_prefix[i])
-            state.tags_prefix[i] = sub(r'\\\)', r')', state.tags_prefix[i])
-
-        for it in state.items:
-            for i in range(len(it.tags)):
-                it.tags[i] = sub(r'\\\(', r'(', it.tags[i])
-                it.tags[i] = sub(r'\\\)', r')', it.tags[i])
-            
-            with open(it.caption_path, 'w') as f:
-                f.write(', '.join(state.tags_prefix + it.tags))
+        _map_tags(state, _unescape_parens)
 
 class DeduplicateTagsOperation(Operation):
     id: Literal['deduplicate_tags']
 
     def run(self, state):
         prefix_tags = set(state.tags_prefix)
+        changed = []
         for it in state.items:
-            tags = []
-            for tag in it.tags:
-                if tag not in tags and tag not in prefix_tags:
-                    tags.append(tag)
+            tags = list(dict.fromkeys(tag for tag in it.tags if tag not in prefix_tags))
 
             if tags != it.tags:
-                with open(it.caption_path, 'w') as f:
-                    f.write(', '.join(state.tags_prefix + tags))
                 it.tags = tags
+                changed.append(it)
+
+        write_captions(((it.caption_path, it.tags) for it in changed), encode_prefix(state.tags_prefix))
 
 class ReplaceTagsOperation(Operation):
     id: Literal['replace_tags']
@@ -67,6 +77,7 @@ class ReplaceTagsOperation(Operation):
     replace: str
 
     def run(self, state):
+        changed = []
         for it in state.items:
             result = []
             for tag in it.tags:
@@ -79,37 +90,40 @@ class ReplaceTagsOperation(Operation):
                     result.append(tag)
             
             if result != it.tags:
-                with open(it.caption_path, 'w') as f:
-                    f.write(', '.join(state.tags_prefix + result))
                 it.tags = result
+                changed.append(it)
+
+        write_captions(((it.caption_path, it.tags) for it in changed), encode_prefix(state.tags_prefix))
     
 class RemoveTagsOperation(Operation):
     id: Literal['remove_tags']
     tags: list[str]
 
     def run(self, state):
-        for it in state.items:
-            result = []
-
-            for tag in it.tags:
-                rm = False
+        literal = frozenset(p for p in self.tags if not (p.startswith('^') and p.endswith('$')))
+        # compiled one by one: joining them would clash on named groups and renumber backreferences
+        patterns = [rcompile(p) for p in self.tags if p.startswith('^') and p.endswith('$')]
 
-                for pattern in self.tags:
-                    if pattern.startswith('^') and pattern.endswith('$'):
-                        if rmatch(pattern, tag):
-                            rm = True
-                            break
-                    else:
-                        if pattern == tag:
-                            rm = True
-                            break
-                if not rm:
-                    result.append(tag)
+        changed = []
+        for it in state.items:
+            result = [
+                tag for tag in it.tags
+                if tag not in literal and not any(p.match(tag) for p in patterns)
+            ]
 
             if result != it.tags:
-                with open(it.caption_path, 'w') as f:
-                    f.write(', '.join(state.tags_prefix + result))
                 it.tags = result
+                changed.append(it)
+
+        write_captions(((it.caption_path, it.tags) for it in changed), encode_prefix(state.tags_prefix))
+
+
+# offsets of the image inside the canvas, in halves of the free space
+ALIGN_POSITIONS = {
+    'top-left': (0, 0), 'top-center': (1, 0), 'top-right': (2, 0),
+    'center-left': (0, 1), 'center': (1, 1), 'center-right': (2, 1),
+    'bottom-left': (0, 2), 'bottom-center': (1, 2), 'bottom-right': (2, 2),
+}
 
 
 class AlignResolutionOperation(Operation):
@@ -122,16 +136,18 @@ class AlignResolutionOperation(Operation):
                       'center', 'center-right', 'bottom-left', 'bottom-center', 'bottom-right']
     
     def run(self, state):
-        bg = Image.new('RGB', (self.width, self.height), self.color)
-
-        for it in state.items:
-            result = bg.copy()
-            img = Image.open(it.image_path)
-            width, height = img.size
-            ratio = min(self.width / width, self.height / height)
-            
-            img = img.resize((int(width * ratio), int(height * ratio)), Image.Resampling.LANCZOS)
-            width, height = img.size
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            futures = [ex.submit(_align_one, self, it.image_path) for it in state.items]
+
+        # images that were aligned are already rewritten on disk, so their box tags must be kept even if others failed
+        changed = []
+        failed = []
+        for it, future in zip(state.items, futures):
+            try:
+                width, height = future.result()
+            except Exception as e:
+                failed.append((it.image_path, e))
+                continue
 
             tags = it.tags.copy()
 
@@ -143,44 +159,64 @@ class AlignResolutionOperation(Operation):
                     tags.append('letterboxed')
 
             if tags != it.tags:
-                with open(it.caption_path, 'w') as f:
-                    f.write(', '.join(state.tags_prefix + it.tags))
-            
-            left, top = 0, 0
-
-            if self.position.startswith('top-'):
-                top = 0
-            elif self.position.startswith('center-'):
-                top = (self.height - height) // 2
-            elif self.position.startswith('bottom-'):
-                top = self.height - height
-            
-            if self.position.endswith('-left'):
-                left = 0
-            elif self.position.endswith('-center'):
-                left = (self.width - width) // 2
-            elif self.position.endswith('-right'):
-                left = (self.width - width)
+                it.tags = tags
+                changed.append(it)
+
+        write_captions(((it.caption_path, it.tags) for it in changed), encode_prefix(state.tags_prefix))
+
+        if failed:
+            path, e = failed[0]
+            raise RuntimeError(f'Failed to align {len(failed)} image(s), first: {path}: {e}') from e
+
+
+def _align_one(op: AlignResolutionOperation, image_path: Path) -> tuple[int, int]:
+    img = Image.open(image_path)
+    width, height = img.size
 
-            if self.position == 'center':
-                top, left = (self.height - height) // 2, (self.width - width) // 2
+    if width == op.width and height == op.height and img.mode == 'RGB':
+        return width, height
 
-            result.paste(img, (left, top))
-            result.save(it.image_path)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    ratio = min(op.width / width, op.height / height)
+
+    size = (int(width * ratio), int(height * ratio))
+    if size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    width, height = img.size
+
+    if width == op.width and height == op.height:
+        img.save(image_path)
+
+        return width, height
+
+    cx, cy = ALIGN_POSITIONS[op.position]
+    left, top = (op.width - width) * cx // 2, (op.height - height) * cy // 2
+
+    result = Image.new('RGB', (op.width, op.height), op.color)
+    result.paste(img, (left, top))
+    result.save(image_path)
+
+    return width, height
 
 class RemoveTransparencyOperation(Operation):
     id: Literal['remove_transparency']
     color: str
 
     def run(self, state):
-        for it in state.items:
-            img = Image.open(it.image_path)
-            
-            if not img.has_transparency_data:
-                continue
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            list(ex.map(partial(_remove_transparency_one, self), [it.image_path for it in state.items]))
+
+
+def _remove_transparency_one(op: RemoveTransparencyOperation, image_path: Path):
+    img = Image.open(image_path)
+
+    if not img.has_transparency_data:
+        return
 
-            result = Image.new(img.mode, img.size, self.color)
+    result = Image.new(img.mode, img.size, op.color)
 
-            result.alpha_composite(img)
+    result.alpha_composite(img)
 
-            result.save(it.image_path)
\ No newline at end of file
+    result.save(image_path)
@@ -1,13 +1,70 @@
-from typing import Literal
+from typing import Any, ClassVar, Literal
 from pathlib import Path
 from os.path import splitext
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
 from PIL import Image, ImageDraw
-from functional import seq
 
 from image_toolkit.types import _BaseModel, DatasetItem, AppState
-from image_toolkit.utils import where
+from image_toolkit.utils import encode_prefix, write_caption
+
+SAVE_OPTIONS: dict[str, dict[str, Any]] = {
+    '.jpg': {'quality': 95, 'subsampling': 0},
+    '.jpeg': {'quality': 95, 'subsampling': 0},
+    '.webp': {'quality': 95, 'method': 4},
+    '.png': {'compress_level': 1},
+}
+
+
+# images are only cached when re-reading them from disk would give back identical pixels
+LOSSLESS_EXT = ('.png',)
+IMAGE_CACHE_SIZE = 8
+
+_image_cache: OrderedDict[Path, tuple[tuple[int, int], Image.Image]] = OrderedDict()
+_image_cache_lock = Lock()
+
+
+def _cache_key(path: Path) -> tuple[int, int]:
+    st = path.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+def _open_image(path: Path) -> Image.Image:
+    key = _cache_key(path)
+    with _image_cache_lock:
+        cached = _image_cache.get(path)
+        if cached is not None and cached[0] == key:
+            _image_cache.move_to_end(path)
+            return cached[1].copy()
+
+    return Image.open(path)
+
+
+def _save_image(img: Image.Image, path: Path):
+    img.save(path, **SAVE_OPTIONS.get(path.suffix.lower(), {}))
+
+    with _image_cache_lock:
+        if path.suffix.lower() not in LOSSLESS_EXT:
+            _image_cache.pop(path, None)
+            return
+
+        _image_cache[path] = (_cache_key(path), img)
+        _image_cache.move_to_end(path)
+        while len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+
+
+def _unlink_image(path: Path):
+    path.unlink()
+
+    with _image_cache_lock:
+        _image_cache.pop(path, None)
+
 
 class Tool(_BaseModel):
+    rewrites_caption: ClassVar[bool] = False
+
     def run(self, state: AppState, idx: int) -> str | None:
         raise NotImplementedError()
 
@@ -36,15 +93,11 @@ class BrushTool(Tool):
 
     def run(self, state, idx):
         item = state.items[idx]
-        img = Image.open(item.image_path)
+        img = _open_image(item.image_path)
         draw = ImageDraw.ImageDraw(img)
         for it in self.drawing:
-            pts = []
-            for pt in it.points:
-                pts.append(pt.x)
-                pts.append(pt.y)
-            draw.line(pts, it.color, it.width)
-        img.save(item.image_path, quality=100)
+            draw.line([(pt.x, pt.y) for pt in it.points], it.color, it.width)
+        _save_image(img, item.image_path)
     
 class RectState(_BaseModel):
     color: str
@@ -58,7 +111,7 @@ class RectTool(Tool):
 
     def run(self, state, idx):
         item = state.items[idx]
-        img = Image.open(item.image_path)
+        img = _open_image(item.image_path)
         width, height = img.size
 
         draw = ImageDraw.ImageDraw(img)
@@ -66,17 +119,19 @@ class RectTool(Tool):
             l, t, r, b = min(it.start.x, it.end.x), min(it.start.y, it.end.y), max(it.start.x, it.end.x), max(it.start.y, it.end.y)
             l, t, r, b = max(0, l), max(0, t), min(width, r), min(height, b)
             draw.rectangle((l, t, r, b), it.color, width=0)
-        img.save(item.image_path, quality=100)
+        _save_image(img, item.image_path)
 
 
 class SplitTool(Tool):
+    rewrites_caption = True
+
     id: Literal['split']
     mode: Literal['cross', 'horizontal', 'vertical']
     point: Point
 
     def run(self, state, idx):
         item = state.items[idx]
-        img = Image.open(item.image_path)
+        img = _open_image(item.image_path)
         width, height = img.size
 
         cropped = []
@@ -100,24 +155,34 @@ class SplitTool(Tool):
             ]
 
         stem, ext = splitext(item.image_path)
-        for i, it in enumerate(cropped):
-            fn = item.image_path.parent / (stem + f'_{i + 1}' + ext)
-            it.save(fn, quality=100)
-            with open(item.image_path.parent / (stem + f'_{i + 1}' + '.txt'), 'w') as f:
-                f.write(', '.join(state.tags_prefix + item.tags))
-
-            state.items.insert(idx + 1 + i, DatasetItem(
-                caption_path=item.image_path.parent / (stem + f'_{i + 1}' + '.txt'),
+        prefix = encode_prefix(state.tags_prefix)
+        jobs = [
+            (it, Path(f'{stem}_{i + 1}{ext}'), Path(f'{stem}_{i + 1}.txt'))
+            for i, it in enumerate(cropped)
+        ]
+
+        with ThreadPoolExecutor(max_workers=min(4, len(jobs))) as ex:
+            list(ex.map(lambda job: _save_split(job[0], job[1], job[2], item.tags, prefix), jobs))
+
+        state.insert_items(idx + 1, [
+            DatasetItem.model_construct(
+                caption_path=caption_path,
                 tags = item.tags.copy(),
-                image_path=item.image_path.parent / (stem + f'_{i + 1}' + ext)
-            ))
-        
-        item.image_path.unlink()
+                image_path=image_path
+            )
+            for _, image_path, caption_path in jobs
+        ])
+
+        _unlink_image(item.image_path)
         item.caption_path.unlink()
-        state.items.pop(idx)
+        state.pop_item(idx)
 
         return stem + '_1' + ext
 
+def _save_split(img: Image.Image, image_path: Path, caption_path: Path, tags: list[str], prefix: bytes):
+    _save_image(img, image_path)
+    write_caption(caption_path, tags, prefix)
+
 class TrimTool(Tool):
     id: Literal['trim']
     top: int
@@ -127,10 +192,10 @@ class TrimTool(Tool):
 
     def run(self, state, idx):
         item = state.items[idx]
-        img = Image.open(item.image_path)
+        img = _open_image(item.image_path)
         width, height = img.size
 
-        img.crop((self.left, self.top, width - self.right, height - self.bottom)).save(item.image_path, quality=100)
+        _save_image(img.crop((self.left, self.top, width - self.right, height - self.bottom)), item.image_path)
 
 class ExpandTool(Tool):
     id: Literal['expand']
@@ -142,7 +207,7 @@ class ExpandTool(Tool):
 
     def run(self, state, idx):
         item = state.items[idx]
-        img = Image.open(item.image_path)
+        img = _open_image(item.image_path)
         width, height = img.size
 
         expanded = Image.new(img.mode, (
@@ -150,9 +215,11 @@ class ExpandTool(Tool):
             height + self.top + self.bottom
         ), self.color)
         expanded.paste(img, (self.left, self.top))
-        expanded.save(item.image_path, quality=100)
+        _save_image(expanded, item.image_path)
 
 class ConcatTool(Tool):
+    rewrites_caption = True
+
     id: Literal['concat']
     mode: Literal['horizontal', 'vertical']
     image: Path
@@ -161,12 +228,11 @@ class ConcatTool(Tool):
 
     def run(self, state, idx):
         item = state.items[idx]
-        img = Image.open(item.image_path)
+        img = _open_image(item.image_path)
         width, height = img.size
 
-        fn = Path(self.image)
-        other, other_idx = where(state.items, lambda it: it.image_path == fn)
-        other_img = Image.open(other.image_path)
+        other, other_idx = state.find_item(Path(self.image))
+        other_img = _open_image(other.image_path)
         other_width, other_height = other_img.size
         out = None
         
@@ -198,15 +264,14 @@ class ConcatTool(Tool):
                 out.paste(img, (self.offset, 0))
                 out.paste(other_img, (0, height))
         
-        out.save(item.image_path)
+        _save_image(out, item.image_path)
         other.caption_path.unlink()
-        other.image_path.unlink()
+        _unlink_image(other.image_path)
 
-        with open(item.caption_path, 'w') as f:
-            for it in other.tags:
-                if it not in item.tags:
-                    item.tags.append(it)
+        for it in other.tags:
+            if it not in item.tags:
+                item.tags.append(it)
 
-            f.write(', '.join(state.tags_prefix + item.tags))
-        
-        state.items.pop(other_idx)
+        write_caption(item.caption_path, item.tags, encode_prefix(state.tags_prefix))
+
+        state.pop_item(other_idx)
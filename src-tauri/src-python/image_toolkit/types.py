@@ -1,4 +1,4 @@
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, PrivateAttr
 from pydantic.alias_generators import to_camel
 from pathlib import Path
 
@@ -21,4 +21,35 @@ class DatasetItem(_BaseModel):
 class AppState(_BaseModel):
     folder: Path | None = None
     tags_prefix: list[str] = []
-    items: list[DatasetItem] = []
\ No newline at end of file
+    items: list[DatasetItem] = []
+
+    _by_path: dict[Path, int] = PrivateAttr(default_factory=dict)
+
+    def reindex(self, start: int = 0):
+        if start == 0:
+            self._by_path = {}
+
+        for i in range(start, len(self.items)):
+            self._by_path[self.items[i].image_path] = i
+
+    def snapshot(self) -> 'AppState':
+        # paths are immutable; only the tag lists are edited in place and need copying
+        return AppState.model_construct(
+            folder=self.folder,
+            tags_prefix=list(self.tags_prefix),
+            items=[it.model_copy(update={'tags': list(it.tags)}) for it in self.items]
+        )
+
+    def find_item(self, path: Path) -> tuple[DatasetItem, int]:
+        idx = self._by_path[path]
+        return self.items[idx], idx
+
+    def insert_items(self, idx: int, items: list[DatasetItem]):
+        self.items[idx:idx] = items
+        self.reindex(idx)
+
+    def pop_item(self, idx: int) -> DatasetItem:
+        item = self.items.pop(idx)
+        del self._by_path[item.image_path]
+        self.reindex(idx)
+        return item
\ No newline at end of file
@@ -1,70 +1,167 @@
-from typing import Iterable, Sequence, Callable, Literal, overload
+from typing import Iterable, Sequence
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import locale
+import shutil
 
 def pairwise_common_prefix[T](a: Sequence[T], b: Sequence[T]) -> list[T]:
-    result = []
-    for i in range(min(len(a), len(b))):
-        if a[i] == b[i]:
-            result.append(a[i])
-        else:
-            break
-    return result
+    if len(a) > len(b):
+        a, b = b, a
 
-def get_common_prefix[T](s: Iterable[Sequence[T]]) -> list[T]:
-    flg = True
-    result = []
+    # the shorter sequence is often a prefix of the other one; one slice comparison checks it in C
+    if b[:len(a)] == a:
+        return list(a)
 
-    for it in s:
-        if flg:
-            flg = False
-            result = list(it)
-        else:
-            result = pairwise_common_prefix(result, it)
+    n = len(a)
+    i = 0
+
+    while i < n and a[i] == b[i]:
+        i += 1
+
+    prefix = a[:i]
+
+    return prefix if isinstance(prefix, list) else list(prefix)
 
-    return list(result)
+def get_common_prefix(s: Iterable[list[str]]) -> list[str]:
+    items = list(s)
 
-@overload
-def get_caption(file: Path, create: Literal[True]) -> Path: ...
+    if not items:
+        return []
+    if len(items) == 1:
+        return list(items[0])
+    # with the prefix already stripped (e.g. after a delete) captions usually differ right away; skip the full scan
+    if items[0][:1] != items[1][:1]:
+        return []
 
-@overload
-def get_caption(file: Path, create: Literal[False]) -> (Path | None): ...
+    # the common prefix of all lists is the common prefix of the lexicographically smallest and largest ones
+    return pairwise_common_prefix(min(items), max(items))
 
-@overload
-def get_caption(file: Path) -> Path: ...
+def _find_caption(file: Path) -> Path | None:
+    base = os.path.splitext(file)[0]
 
+    for result in (base + '.txt', os.fspath(file) + '.txt', base):
+        if os.path.exists(result):
+            return Path(result)
 
-def get_caption(file: Path, create: bool = True):
-    result = file.parent / (file.stem + '.txt')
+    return None
 
-    if not result.exists():
-        result = file.parent / (file.name + '.txt')
-    if not result.exists():
-        result = file.parent / file.stem
-    if not result.exists():
-        if not create:
-            return None
-        
-        result = file.parent / (file.stem + '.txt')
+def get_caption_or_none(file: Path) -> Path | None:
+    return _find_caption(file)
+
+def get_caption_or_create(file: Path) -> Path:
+    result = _find_caption(file)
+
+    if result is None:
+        result = file.with_suffix('.txt')
         result.touch()
 
     return result
 
+def get_caption_batch(files: Iterable[Path]) -> list[Path]:
+    # one listdir per directory instead of up to three stats per file; misses fall back to get_caption_or_create
+    listings: dict[Path, set[str]] = {}
+    result = []
+
+    for file in files:
+        parent = file.parent
+        names = listings.get(parent)
+        if names is None:
+            names = listings[parent] = set(os.listdir(parent))
+
+        for name in (file.stem + '.txt', file.name + '.txt', file.stem):
+            if name in names:
+                result.append(parent / name)
+                break
+        else:
+            result.append(get_caption_or_create(file))
+
+    return result
+
+def _reserve(path: Path) -> bool:
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    except FileExistsError:
+        return False
+
+    return True
+
+def _free_index(dest: Path, stem: str, suffix: str, start: int) -> int:
+    # double until a free name is found, then binary search back towards the last taken one
+    lo, hi = start - 1, start
+    while (dest / f'{stem}_{hi}{suffix}').exists():
+        lo, hi = hi, hi * 2
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if (dest / f'{stem}_{mid}{suffix}').exists():
+            lo = mid
+        else:
+            hi = mid
+
+    return hi
+
 def copy(source: Path, dest: Path):
     target = dest / source.name
     i = 1
 
-    while target.exists():
-        target = dest / (source.stem + f'_{i}' + source.suffix)
-        i += 1
+    while not _reserve(target):
+        i = _free_index(dest, source.stem, source.suffix, i)
+        target = dest / f'{source.stem}_{i}{source.suffix}'
+
+    try:
+        shutil.copyfile(source, target)
+    except BaseException:
+        target.unlink(missing_ok=True)
+        raise
 
-    with open(target, 'wb') as out, open(source, 'rb') as f:
-        out.write(f.read())
-    
     return target
 
-def where[T](seq: Sequence[T], pred: Callable[[T], bool]):
-    for i, it in enumerate(seq):
-        if pred(it):
-            return it, i
-        
-    raise RuntimeError('Value not found')
\ No newline at end of file
+def read_caption(path: Path) -> list[str]:
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        data = os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+    try:
+        caption = data.decode()
+    except UnicodeDecodeError:
+        # older builds wrote captions in the locale encoding; anything else is refused rather than rewritten lossily
+        try:
+            caption = data.decode(locale.getpreferredencoding(False))
+        except UnicodeDecodeError as e:
+            raise ValueError(f'Cannot decode caption {path}: {e}') from e
+
+    return [it.strip() for it in caption.split(',')]
+
+def read_captions(paths: Iterable[Path]) -> list[list[str]]:
+    with ThreadPoolExecutor(max_workers=32) as ex:
+        return list(ex.map(read_caption, paths))
+
+def encode_prefix(tags: Sequence[str]) -> bytes:
+    return (', '.join(tags) + ', ').encode() if tags else b''
+
+def write_caption(path: Path, tags: Sequence[str], prefix: bytes = b''):
+    # prefix comes from encode_prefix and carries a trailing separator, which is dropped if there are no tags
+    parts = [prefix, ', '.join(tags).encode()] if tags else [prefix[:-2]]
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, parts)
+            if written == sum(map(len, parts)):
+                return
+            data = memoryview(b''.join(parts))[written:]
+        else:
+            data = memoryview(b''.join(parts))
+
+        # writes may be short, keep going until everything is on disk
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def write_captions(captions: Iterable[tuple[Path, Sequence[str]]], prefix: bytes = b''):
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        list(ex.map(lambda it: write_caption(it[0], it[1], prefix), captions))